@@ -5,6 +5,8 @@
 
 import csv
 
+import ahocorasick
+
 fpwords = ['foo',
            'bar',
            'example',
@@ -47,17 +49,27 @@ fpwords = ['foo',
            ]
 
 
-def fpfilter(x):
-    for (k,v) in x.items():
-        for badword in fpwords:
-            if badword.lower() in v.lower():
-                return False
-    return True
+# lowercase and dedupe the blacklist once at import rather than for every row, shortest words first
+FPWORDS_LC = tuple(sorted({badword.lower() for badword in fpwords}, key=lambda w: (len(w), w)))
+
+# build the Aho-Corasick automaton once so each row is a single linear scan
+fpautomaton = ahocorasick.Automaton()
+for badword in FPWORDS_LC:
+    fpautomaton.add_word(badword, badword)
+fpautomaton.make_automaton()
+
+
+def fpfilter(row):
+    # join with NUL so a badword can't match across two columns
+    joined = "\x00".join(row).lower()
+    return not any(True for _ in fpautomaton.iter(joined))
 
 
-with open('output.csv') as f:
-    reader = csv.DictReader(f)
-    out = filter(fpfilter, reader)
-    with open('output_filtered.csv', 'w') as o:
-        writer = csv.DictWriter(o, fieldnames=['Repository','reason','stringsFound','path','commit','commitHash','date'])
-        writer.writerows(out)
+with open('output.csv', newline='') as f:
+    reader = csv.reader(f)
+    header = next(reader)
+    with open('output_filtered.csv', 'w', newline='') as o:
+        writer = csv.writer(o)
+        writer.writerow(header)
+        # rows are streamed straight from the reader through the filter into the writer
+        writer.writerows(filter(fpfilter, reader))
@@ -1,19 +1,23 @@
 # A python script to "scan" a GDrive folder containing docs and binaries.
-# You will need the Google Python API libraries:
-#   pip install --upgrade google-api-python-client google-auth-httplib2 google-auth-oauthlib
+# You will need the Google Python API libraries and orjson:
+#   pip install --upgrade google-api-python-client google-auth-httplib2 google-auth-oauthlib orjson
 
 from __future__ import print_function
 
 import csv
-import io
+import itertools
 import json
+import orjson
 import os.path
 import random
+import shutil
 import subprocess
 import sys
 import tempfile
-import uuid
-from multiprocessing import Pool
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from functools import lru_cache
 from tempfile import tempdir
 
 from googleapiclient.discovery import build
@@ -32,59 +36,162 @@ ANKAMALI_HOG_PATH = os.environ["ANKAMALI_HOG_PATH"]
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 tempdir = tempfile.gettempdir()
-creds = None
-# The file token.json stores the user's access and refresh tokens, and is
-# created automatically when the authorization flow completes for the first
-# time.
-if os.path.exists('temptoken_scanner.json'):
-    creds = Credentials.from_authorized_user_file('temptoken_scanner.json', SCOPES)
-# If there are no (valid) credentials available, let the user log in.
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
+
+
+@lru_cache(maxsize=None)
+def get_creds():
+    creds = None
+    saved_token = None
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists('temptoken_scanner.json'):
+        with open('temptoken_scanner.json', 'r') as token:
+            saved_token = token.read()
+        creds = Credentials.from_authorized_user_info(json.loads(saved_token), SCOPES)
+    # Refresh a few minutes early so the token can't lapse part way through a scan,
+    # otherwise if there are no (valid) credentials available, let the user log in.
+    if creds and creds.refresh_token and (creds.expired or (creds.expiry and creds.expiry - datetime.utcnow() < timedelta(minutes=5))):
         creds.refresh(Request())
-    else:
+    elif not creds or not creds.valid:
         flow = InstalledAppFlow.from_client_secrets_file(
             'clientsecret.json', SCOPES)
         creds = flow.run_local_server(port=0)
-    # Save the credentials for the next run
-    with open('temptoken_scanner.json', 'w') as token:
-        token.write(creds.to_json())
+    # Save the credentials for the next run, but only if they changed
+    new_token = creds.to_json()
+    if new_token != saved_token:
+        with open('temptoken_scanner.json', 'w') as token:
+            token.write(new_token)
+    return creds
+
+# Google Workspace types can't be downloaded as-is, so duroc_hog skips them
+MIME_BLOCK = frozenset([
+    'application/vnd.google-apps.audio',
+    'application/vnd.google-apps.document',
+    'application/vnd.google-apps.drive',
+    'application/vnd.google-apps.drawing',
+    'application/vnd.google-apps.file',
+    'application/vnd.google-apps.folder',
+    'application/vnd.google-apps.form',
+    'application/vnd.google-apps.fusiontable',
+    'application/vnd.google-apps.map',
+    'application/vnd.google-apps.photo',
+    'application/vnd.google-apps.presentation',
+    'application/vnd.google-apps.script',
+    'application/vnd.google-apps.shortcut',
+    'application/vnd.google-apps.site',
+    'application/vnd.google-apps.spreadsheet',
+    'application/vnd.google-apps.unknown',
+    'application/vnd.google-apps.video'
+])
+ANKAMALI_MIMES = frozenset([
+    'application/vnd.google-apps.document',
+    'application/vnd.google-apps.spreadsheet'
+])
 
-SERVICE = build('drive', 'v3', credentials=creds)
+# the scans mostly wait on the Drive API and the hog subprocesses, so use more threads than cores
+MAX_WORKERS = (os.cpu_count() or 1) * 4
+
+# httplib2 (used by the Drive client) is not thread-safe, so each worker thread gets its own service
+thread_local = threading.local()
+
+
+def get_service():
+    if not hasattr(thread_local, 'service'):
+        thread_local.service = build('drive', 'v3', credentials=get_creds())
+    return thread_local.service
 
 
 def scan_ankamali(x):
-    filename = os.path.join(tempdir, str(uuid.uuid4()))
+    fd, filename = tempfile.mkstemp(prefix='hog_', suffix='.json', dir=tempdir)
+    os.close(fd)
     print(f"Fetching {x['id']}")
     s = subprocess.run([ANKAMALI_HOG_PATH, "--outputfile", filename, x['id']],
                        capture_output=True)
     return {"id": x['id'], "results": filename}
 
 def scan_duroc(x):
-    results_filename = os.path.join(tempdir, str(uuid.uuid4()))
-    scan_target_filename = os.path.join(tempdir, x['name'])
+    fd, results_filename = tempfile.mkstemp(prefix='hog_', suffix='.json', dir=tempdir)
+    os.close(fd)
+    # Drive names aren't unique and the workers run concurrently, so each download gets its own directory,
+    # keeping the original name so duroc_hog can still tell the archive type from the extension
+    staging_dir = tempfile.mkdtemp(prefix='duroc_', dir=tempdir)
+    scan_target_filename = os.path.join(staging_dir, os.path.basename(x['name']))
 
     print(f"Fetching {x['id']} {x['webContentLink']} {x['name']} and writing to {scan_target_filename}")
-    request = SERVICE.files().get_media(fileId=x['id'])
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    with open(scan_target_filename, 'wb') as f:
-        f.write(fh.getbuffer())
-        f.close()
-    s = subprocess.run([DUROC_HOG_PATH, "-z", scan_target_filename],
-                       capture_output=True)
+    request = get_service().files().get_media(fileId=x['id'])
+    # download straight into the scan target rather than buffering the whole file in memory first,
+    # duroc_hog needs a seekable file with the right extension to unpack archives so it can't read from a pipe
+    try:
+        with open(scan_target_filename, 'wb') as f:
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
+        s = subprocess.run([DUROC_HOG_PATH, "--outputfile", results_filename, "-z", scan_target_filename],
+                           capture_output=True)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
     print(s.stdout)
     print(s.stderr)
-    # os.remove(scan_target_filename)
     return {"id": x['id'], "results": results_filename, "name": x['name'], "link": x['webContentLink']}
 
+def write_duroc_results(writer, result):
+    try:
+        print(f"Reading duroc hog results {result['results']}")
+        with open(result['results'], 'rb') as f:
+            result_list = orjson.loads(f.read())
+            writer.writerows([(result['id'],
+                               finding['reason'],
+                               str(finding['stringsFound']),
+                               result['name'],
+                               finding['linenum'],
+                               result['link']) for finding in result_list])
+    except:
+        print("Unexpected error:", sys.exc_info()[0])
+    try:
+        os.remove(result['results'])
+    except:
+        print("Unexpected error:", sys.exc_info()[0])
+
+def write_ankamali_results(writer, result):
+    try:
+        with open(result['results'], 'rb') as f:
+            result_list = orjson.loads(f.read())
+            writer.writerows([(result['id'],
+                               finding['reason'],
+                               str(finding['stringsFound']),
+                               finding['path'],
+                               finding['date']) for finding in result_list])
+    except:
+        print(f"Couldn't find ankamali hog output {result['results']}")
+    try:
+        os.remove(result['results'])
+    except:
+        pass
+
+def list_files(file_get_kwargs):
+    file_get_kwargs = dict(file_get_kwargs)
+    page = 1
+    print(f"Fetching page {page} of {file_get_kwargs.get('q', 'all files')}")
+    results = get_service().files().list(**file_get_kwargs).execute()
+    page += 1
+    pages = [results.get('files', [])]
+    nextPageToken = results.get('nextPageToken', None)
+    while nextPageToken:
+        file_get_kwargs['pageToken'] = nextPageToken
+        print(f"Fetching page {page} of {file_get_kwargs.get('q', 'all files')}")
+        results = get_service().files().list(**file_get_kwargs).execute()
+        page += 1
+        pages.append(results.get('files', []))
+        nextPageToken = results.get('nextPageToken', None)
+    # flatten once at the end instead of growing one list page by page
+    return list(itertools.chain.from_iterable(pages))
+
 def parseargs():
     parser = argparse.ArgumentParser()
     parser.add_argument("--driveid", help="GDrive id of drive to scan, defaults to user's drive")
-    parser.add_argument("-f", "--folder", help="Scan within specific folder ID")
+    parser.add_argument("-f", "--folder", help="Scan within specific folder ID, can be repeated", action='append')
     parser.add_argument("-r", "--recursive", help="Scan files with parents")
     parser.add_argument("--sample", help="Only scan a sample of available files", type=int)
     parser.add_argument("--modifiedTime", help="Only scan files after a specific date (ISO format)", type=int)
@@ -96,116 +203,62 @@ def main(args):
     Prints the names and ids of the first 10 files the user has access to.
     """
 
+    # authenticate once up front, before any worker threads ask for the credentials
+    get_creds()
+
     # Call the Drive v3 API
     file_get_kwargs = {
-        'pageSize': 100,
-        'fields': 'nextPageToken, files(contentHints/thumbnail,fileExtension,iconLink,id,name,size,thumbnailLink,webContentLink,webViewLink,mimeType,parents)',
+        # 1000 is the largest page the Drive API allows, and only request the fields we actually use
+        'pageSize': 1000,
+        'fields': 'nextPageToken, files(id,name,size,webContentLink,mimeType,parents)',
         'corpora': args.scope
     }
     if args.driveid:
         file_get_kwargs['driveId'] = args.driveid
     if args.folder:
-        file_get_kwargs['q'] = f"'{args.folder}' in parents"
-    page = 1
-    print(f"Fetching page {page}")
-    results = SERVICE.files().list(**file_get_kwargs).execute()
-    page += 1
-    files = results.get('files', [])
-    nextPageToken = results.get('nextPageToken', None)
-    while nextPageToken:
-        file_get_kwargs['pageToken'] = nextPageToken
-        print(f"Fetching page {page}")
-        results = SERVICE.files().list(**file_get_kwargs).execute()
-        page += 1
-        files += results.get('files', [])
-        nextPageToken = results.get('nextPageToken', None)
+        # each folder is an independent listing, so fetch them concurrently
+        list_kwargs = [dict(file_get_kwargs, q=f"'{folder}' in parents") for folder in args.folder]
+        with ThreadPoolExecutor(max_workers=min(len(list_kwargs), MAX_WORKERS)) as executor:
+            files = list(itertools.chain.from_iterable(executor.map(list_files, list_kwargs)))
+    else:
+        files = list_files(file_get_kwargs)
     print("Completed fetching file-listing")
-    files = list(filter(lambda x: x['mimeType'] != 'application/vnd.google-apps.folder', files))
-    ankamali_hog_files = list(filter(lambda x: x['mimeType'] == 'application/vnd.google-apps.spreadsheet' or x['mimeType'] == 'application/vnd.google-apps.document', files))
-    mime_block_list = [
-        'application/vnd.google-apps.audio',
-        'application/vnd.google-apps.document',
-        'application/vnd.google-apps.drive',
-        'application/vnd.google-apps.drawing',
-        'application/vnd.google-apps.file',
-        'application/vnd.google-apps.folder',
-        'application/vnd.google-apps.form',
-        'application/vnd.google-apps.fusiontable',
-        'application/vnd.google-apps.map',
-        'application/vnd.google-apps.photo',
-        'application/vnd.google-apps.presentation',
-        'application/vnd.google-apps.script',
-        'application/vnd.google-apps.shortcut',
-        'application/vnd.google-apps.site',
-        'application/vnd.google-apps.spreadsheet',
-        'application/vnd.google-apps.unknown',
-        'application/vnd.google-apps.video'
-    ]
-    duroc_hog_files = list(filter(lambda x: x['mimeType'] not in mime_block_list, files))
+    # sort the listing into docs for ankamali_hog and downloadable files for duroc_hog in a single pass,
+    # folders are in MIME_BLOCK so they fall through both checks
+    ankamali_hog_files, duroc_hog_files = [], []
+    for x in files:
+        mime_type = x['mimeType']
+        if mime_type in ANKAMALI_MIMES:
+            ankamali_hog_files.append(x)
+        elif mime_type not in MIME_BLOCK:
+            duroc_hog_files.append(x)
     if args.sample:
         if len(ankamali_hog_files) > args.sample:
             ankamali_hog_files = random.sample(ankamali_hog_files, args.sample)
         if len(duroc_hog_files) > args.sample:
             duroc_hog_files = random.sample(duroc_hog_files, args.sample)
 
-    output_ankamali = []
-    output_duroc = []
-
     print("Starting the Rusty Hog scanning process...")
 
-    if len(ankamali_hog_files) > 0:
-        with Pool(4) as p:
-            output_ankamali.extend(p.map(scan_ankamali, ankamali_hog_files))
-
-    if len(duroc_hog_files) > 0:
-        with Pool(4) as p:
-            output_duroc.extend(p.map(scan_duroc, duroc_hog_files))
-
-    print("Complete! Dumping output to output_duroc.csv...")
-
-    with open('output_duroc.csv', 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['id', 'reason', 'stringsFound', 'path', 'linenum', 'weblink'])
-        for result in output_duroc:
-            try:
-                print(f"Reading duroc hog results {result['results']}")
-                with open(result['results'], 'r') as f:
-                    result_list = json.load(f)
-                    for finding in result_list:
-                        writer.writerow([result['id'],
-                                         finding['reason'],
-                                         str(finding['stringsFound']),
-                                         result['name'],
-                                         finding['linenum'],
-                                         result['link']])
-            except:
-                print("Unexpected error:", sys.exc_info()[0])
-            try:
-                os.remove(result['results'])
-            except:
-                print("Unexpected error:", sys.exc_info()[0])
-
-    print("Complete! Dumping output to output_ankamali.csv...")
-
-    with open('output_ankamali.csv', 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['id', 'reason', 'stringsFound', 'path', 'date'])
-        for result in output_ankamali:
-            try:
-                with open(result['results'], 'r') as f:
-                    result_list = json.load(f)
-                    for finding in result_list:
-                        writer.writerow([result['id'],
-                                         finding['reason'],
-                                         str(finding['stringsFound']),
-                                         finding['path'],
-                                         finding['date']])
-            except:
-                print(f"Couldn't find duroc hog output {result['results']}")
-            try:
-                os.remove(result['results'])
-            except:
-                pass
+    # write out each scan's results as soon as it finishes, so temp files are cleaned up as we go
+    # instead of everything waiting on the slowest scan
+    with open('output_duroc.csv', 'w', newline='', buffering=1 << 20) as duroc_csvfile, \
+            open('output_ankamali.csv', 'w', newline='', buffering=1 << 20) as ankamali_csvfile:
+        duroc_writer = csv.writer(duroc_csvfile)
+        duroc_writer.writerow(['id', 'reason', 'stringsFound', 'path', 'linenum', 'weblink'])
+        ankamali_writer = csv.writer(ankamali_csvfile)
+        ankamali_writer.writerow(['id', 'reason', 'stringsFound', 'path', 'date'])
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(scan_ankamali, x): (write_ankamali_results, ankamali_writer)
+                       for x in ankamali_hog_files}
+            futures.update({executor.submit(scan_duroc, x): (write_duroc_results, duroc_writer)
+                            for x in duroc_hog_files})
+            for future in as_completed(futures):
+                write_results, writer = futures[future]
+                write_results(writer, future.result())
+
+    print("Complete! Output written to output_duroc.csv and output_ankamali.csv")
 
 
 
@@ -1,13 +1,12 @@
 # This script takes a Github access token and the name of an organization, and runs Choctaw_hog for each repo
-# It runs the scans in a multi-processing pool, and collects the results and writes them to output.csv
+# It runs the scans in a thread pool, and collects the results and writes them to output.csv
 # It is meant to be used with false_positives.py
-# It requires a single third party library: https://github.com/PyGithub/PyGithub
+# It requires two third party libraries: https://github.com/PyGithub/PyGithub and https://github.com/ijl/orjson
 from github import Github
 import subprocess
-from multiprocessing import Pool
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import tempfile
-import uuid
 import os
 import csv
 import sys
@@ -31,37 +30,37 @@ tempdir = tempfile.gettempdir()
 
 
 def f(x):
-    filename = os.path.join(tempdir, str(uuid.uuid4()))
+    fd, filename = tempfile.mkstemp(prefix='hog_', suffix='.json', dir=tempdir)
+    os.close(fd)
     # expects choctaw_hog in your path
     s = subprocess.run(["choctaw_hog", "--outputfile", filename, x.ssh_url],
                        capture_output=True)
     return {"repo": x.name, "results": filename}
 
 
-output = []
+print("Scanning, writing results to output.csv as each repo completes...")
 
-with Pool(4) as p: # increase this number to the number of cores you have - runs great on a c5n.4xlarge with 14
-    output.extend(p.map(f, repos_to_scan))
-
-print("Complete! Dumping output to output.csv...")
-
-with open('output.csv', 'w') as csvfile:
+with open('output.csv', 'w', newline='', buffering=1 << 20) as csvfile:
     writer = csv.writer(csvfile)
     writer.writerow(['Repository', 'reason', 'stringsFound', 'path', 'commit', 'commitHash', 'date'])
-    for result in output:
-        try:
-            with open(result['results'], 'r') as f:
-                result_list = json.load(f)
-                for finding in result_list:
-                    writer.writerow([result['repo'],
-                                     finding['reason'],
-                                     str(finding['stringsFound']),
-                                     finding['path'],
-                                     finding['commit'],
-                                     finding['commitHash'],
-                                     finding['date']])
-        except:
-            pass
-        os.remove(result['results'])
+    # each worker just waits on a choctaw_hog subprocess, so threads are enough and we can use more of them than cores
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+        futures = [executor.submit(f, repo) for repo in repos_to_scan]
+        # write out each repo as soon as its scan finishes, so temp files are cleaned up as we go
+        for future in as_completed(futures):
+            result = future.result()
+            try:
+                with open(result['results'], 'rb') as results_file:
+                    result_list = orjson.loads(results_file.read())
+                    writer.writerows([(result['repo'],
+                                       finding['reason'],
+                                       str(finding['stringsFound']),
+                                       finding['path'],
+                                       finding['commit'],
+                                       finding['commitHash'],
+                                       finding['date']) for finding in result_list])
+            except:
+                pass
+            os.remove(result['results'])
 
 print("Output written to output.csv")
@@ -19,21 +19,26 @@
 #
 # You can then perform a one-time execution of secret_monitor with the command
 # `sudo service ghe_secret_monitor start` and examine the results in /var/log/messages
+# It requires three third party libraries: https://github.com/PyGithub/PyGithub, https://github.com/psf/requests
+# and https://github.com/ijl/orjson
 
 from datetime import datetime, timedelta
-from github import Github, GithubException
-from multiprocessing import Pool, freeze_support
+from github import Github, GithubException, RateLimitExceededException
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import namedtuple, defaultdict
+from functools import lru_cache
 import gzip
-import json
+import orjson
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
 import tempfile
-import uuid
 import logging
 import sys
 import random
+import time
 import urllib.parse
 
 # initialize auth tokens, fail if not present
@@ -44,10 +49,58 @@ INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 GHE_DOMAIN = os.environ["GHE_DOMAIN"]
 CHOCTAW_HOG_PATH = os.environ["CHOCTAW_HOG_PATH"]
 ALLOW_LIST_PATH = os.environ["ALLOW_LIST_PATH"]
-TEMPDIR = tempfile.gettempdir()
+# the result files are written once and read straight back, so keep them in RAM when tmpfs is available
+TEMPDIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+# how many times to wait out the API rate limit for one repo before giving up on it
+RATE_LIMIT_RETRIES = 3
+# the search API returns at most this many results for a query
+SEARCH_LIMIT = 1000
+# smaller batches keep each POST well under the Insights payload limit and let several upload at once
+INSIGHTS_BATCH_SIZE = 500
+INSIGHTS_WORKERS = 8
+# payloads smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 4096
+
+# findings with these reasons also get a comment on the offending commit
+COMMENT_WORTHY = frozenset([
+    "Amazon AWS Access Key ID",
+    "Amazon MWS Auth Token",
+    "Slack Token",
+    "GitHub",
+    "MailChimp API Key",
+    "Mailgun API Key",
+    "Slack Webhook",
+    "New Relic Insights Key (specific)",
+    "New Relic Insights Key (vague)",
+    "New Relic License Key",
+    "New Relic HTTP Auth Headers and API Key",
+    "New Relic API Key Service Key (new format)",
+    "New Relic APM License Key (new format)",
+    "New Relic APM License Key (new format, region-aware)",
+    "New Relic REST API Key (new format)",
+    "New Relic Admin API Key (new format)",
+    "New Relic Insights Insert Key (new format)",
+    "New Relic Insights Query Key (new format)",
+    "New Relic Synthetics Private Location Key (new format)"
+])
+
+# reuse keep-alive connections for all of the Insights POSTs, and retry them with backoff when Insights is
+# throttling us or having trouble
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=INSIGHTS_WORKERS,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+    ),
+))
 
 def scan_repo(x):
-    filename = os.path.join(TEMPDIR, str(uuid.uuid4()))
+    fd, filename = tempfile.mkstemp(prefix='hog_', suffix='.json', dir=TEMPDIR)
+    os.close(fd)
     cmdline = [
         CHOCTAW_HOG_PATH,
         "--outputfile",
@@ -63,15 +116,52 @@ def scan_repo(x):
     logging.info(f"Running choctaw hog: {str(cmdline)}")
     s = subprocess.run(cmdline, capture_output=True)
     logging.info(f"choctaw hog output: {s.stdout} {s.stderr}")
-    return {"repo": x[0], "results": filename, "url": x[1][1]}
+    result_dict = {"repo": x[0], "url": x[1][1], "findings": None, "events": []}
+
+    # parse the results here so it overlaps with the other workers' scans instead of happening afterwards
+    with open(filename, "rb") as f:
+        contents = f.read()
+    os.remove(filename)
+    if not contents:
+        # the results file is created before the scan, so it will be empty if we couldn't
+        # access the git repo
+        logging.warning(f"no results for {x[0]}")
+        return result_dict
+    result_dict["findings"] = orjson.loads(contents)
+    for finding in result_dict["findings"]:
+        fileurl = ""
+        if finding["new_line_num"] != 0:
+            fileurl = f"{x[1][1]}/blob/{finding['commitHash']}/{finding['path']}#L{finding['new_line_num']}"
+        else:
+            fileurl = f"{x[1][1]}/blob/{finding['parent_commit_hash']}/{finding['path']}#L{finding['old_line_num']}"
+        result_dict["events"].append(
+            {
+                "eventType": "ghe_secret_monitor",
+                "commitHash": finding["commitHash"],
+                "reason": finding["reason"],
+                "path": finding["path"],
+                "repo": x[0],
+                "url": f"{x[1][1]}/commit/{finding['commitHash']}/{finding['path']}",
+                "fileurl": fileurl,
+                "old_line_num": finding["old_line_num"],
+                "new_line_num": finding["new_line_num"],
+                "parent_commitHash": finding["parent_commit_hash"]
+            }
+        )
+    return result_dict
 
 def main():
     loglevel = "WARNING"
     sample = False
     knownbad = None
+    # threads are enough since the work happens in the choctaw_hog subprocesses, which clone and scan the history
+    # and are CPU and disk bound, so run one per core unless --jobs says otherwise
+    jobs = os.cpu_count() or 1
     for arg in sys.argv:
         if arg.startswith("--sample="):
             sample = int(arg[9:])
+        if arg.startswith("--jobs="):
+            jobs = int(arg[7:])
         if arg.startswith("--log="):
             loglevel = arg[6:]
         if arg.startswith("--knownbad="):
@@ -84,131 +174,126 @@ def main():
     # initialize GitHub object and list of all repos
     logging.info("Trying to authenticate to Github...")
     g = Github(base_url=f"https://{GHE_DOMAIN}/api/v3", login_or_token=GHE_REPO_TOKEN, per_page=100)
+
+    # many findings share a repo or commit, so only hit the API once for each
+    @lru_cache(maxsize=None)
+    def get_repo(name):
+        return g.get_repo(name)
+
+    @lru_cache(maxsize=4096)
+    def get_commit(name, sha):
+        return get_repo(name).get_commit(sha)
+
+    # use the datetime library to get an object representing 24 hours ago
+    today = datetime.today()
+    twentyfourhoursago = today - timedelta(hours=24)
+
+    def search_pushed(start, end):
+        # the search API never returns more than SEARCH_LIMIT results, so split the window in half until each piece
+        # fits, listing the older half first so a repo pushed to mid-listing moves into a window not yet listed
+        query = f"pushed:{start:%Y-%m-%dT%H:%M:%SZ}..{end:%Y-%m-%dT%H:%M:%SZ} fork:true"
+        results = g.search_repositories(query=query)
+        if results.totalCount < SEARCH_LIMIT:
+            return list(results)
+        if end - start <= timedelta(minutes=1):
+            return None
+        middle = start + (end - start) / 2
+        older = search_pushed(start, middle)
+        newer = search_pushed(middle, end) if older is not None else None
+        if newer is None:
+            return None
+        return older + newer
+
     repos = []
     if knownbad:
         repos.append(g.get_repo(knownbad))
     else:
-        repos = g.get_repos()
+        # let GitHub filter out repos without recent pushes instead of paging through every repo on the instance,
+        # the exact cutoff is applied by get_commits(since=...) below
+        now = datetime.utcnow()
+        # get_commits sends the local cutoff as if it were UTC, so start early enough to cover it either way
+        found = search_pushed(min(twentyfourhoursago, now - timedelta(hours=24)) - timedelta(hours=1), now)
+        if found is None:
+            logging.error(f"more than {SEARCH_LIMIT} repos were pushed to within a minute, the search results would be "
+                          f"truncated so falling back to listing every repo")
+            repos = g.get_repos()
+        else:
+            # the windows share their boundaries, so a repo can be found twice
+            repos = list({repo.full_name: repo for repo in found}.values())
     if sample:
         logging.info(f"sample size set to {sample}, retrieving list of repos...")
-        repos = random.sample(list(repos), sample)
-
-    # use the datetime library to get an object representing 48 hours ago
-    today = datetime.today()
-    twentyfourhoursago = today - timedelta(hours=24)
+        repos = list(repos)
+        repos = random.sample(repos, min(sample, len(repos)))
 
     # start the first main set of work: translate our list of repo objects to a dict of { git_url : since_commit_hash }
-    repo_dict = {}
-    logging.info("Getting a list of all commits since 24 hours ago for each repo...")
-    for repo in repos:
-        commits = []
-        issues = []
-        try:
-            commits = list(repo.get_commits(since=twentyfourhoursago))
-            issues = list(repo.get_issues(since=twentyfourhoursago))
-        except GithubException as e:
-            logging.debug(e)
-            continue
+    def head_commit(repo):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                commits = list(repo.get_commits(since=twentyfourhoursago))
+                break
+            except RateLimitExceededException:
+                if attempt == RATE_LIMIT_RETRIES:
+                    logging.warning(f"still rate limited after {RATE_LIMIT_RETRIES} retries, skipping {repo.full_name}")
+                    return None
+                # running this many requests at once can exhaust the rate limit, wait for it to reset and try again
+                logging.warning(f"rate limited while listing commits for {repo.full_name}, waiting for reset")
+                time.sleep(max(g.rate_limiting_resettime - time.time(), 0) + 1)
+            except GithubException as e:
+                logging.debug(e)
+                return None
         if len(commits) == 0:
             logging.debug("len(commits) == 0")
-            continue
+            return None
         if not repo.ssh_url:
             logging.debug("no SSH URL")
-            continue
+            return None
         logging.info(f"({repo.ssh_url}, {commits[-1].sha}")
-        repo_dict[repo.ssh_url] = (commits[-1].sha, repo.html_url)
+        return repo.ssh_url, commits[-1].sha, repo.html_url
+
+    repo_dict = {}
+    logging.info("Getting a list of all commits since 24 hours ago for each repo...")
+    # these are independent API requests, so run them concurrently, the API rate limit is the real ceiling here
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        futures = [executor.submit(head_commit, repo) for repo in repos]
+        for future in as_completed(futures):
+            result = future.result()
+            if result:
+                repo_dict[result[0]] = (result[1], result[2])
 
     logging.info("Completed Github API requests...")
-    repo_dict = dict(
-        filter(lambda x: x[1], repo_dict.items())
-    )  # and filter out key/value pairs with None as a value
 
     logging.info(f"len(repo_dict) = {len(repo_dict)}")
 
     # start the next block of work, run choctaw_hog for each key/value pair in repo_dict, and return a dict containing the
-    # git url as the key and the filename containing the results as the value
+    # git url, the parsed findings and the Insights events built from them
 
     logging.info("Starting choctaw hog scan of all commits over the last 24 hours...")
 
-    output = []
-
-    # increase this number to the number of cores you have - runs great on a c5n.4xlarge with 14
-    with Pool(3) as p:
-        output.extend(p.map(scan_repo, repo_dict.items()))
-
-    logging.info(f"len(output) = {len(output)}")
-    logging.debug(output)
-
-    # the last block of work, iterate through each JSON file from choctaw_hog and put the results in Insights
+    # the last block of work, iterate through each JSON file from choctaw_hog and put the results in Insights,
+    # handling each repo's results as soon as its scan finishes instead of waiting for the slowest one
     logging.info("Collecting choctaw hog output into a single python list...")
     output_array = []
-    comment_worthy_reasons = [
-        "Amazon AWS Access Key ID",
-        "Amazon MWS Auth Token",
-        "Slack Token",
-        "GitHub",
-        "MailChimp API Key",
-        "Mailgun API Key",
-        "Slack Webhook",
-        "New Relic Insights Key (specific)",
-        "New Relic Insights Key (vague)",
-        "New Relic License Key",
-        "New Relic HTTP Auth Headers and API Key",
-        "New Relic API Key Service Key (new format)",
-        "New Relic APM License Key (new format)",
-        "New Relic APM License Key (new format, region-aware)",
-        "New Relic REST API Key (new format)",
-        "New Relic Admin API Key (new format)",
-        "New Relic Insights Insert Key (new format)",
-        "New Relic Insights Query Key (new format)",
-        "New Relic Synthetics Private Location Key (new format)"
-    ]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(scan_repo, item) for item in repo_dict.items()]
+        for future in as_completed(futures):
+            result_dict = future.result()
+            logging.debug(result_dict)
+            if result_dict["findings"] is None:
+                continue
+            output_array.extend(result_dict["events"])
 
-    for result_dict in output:
-        try:
-            f = open(result_dict["results"], "r")
-        except:
-            # TODO: add better error handling here. the file won't exist if we couldn't
-            # access the git repo
-            logging.warning("failed to open " + result_dict["results"])
-            continue
-
-        with f:
-            result_list = json.load(f)
+            repo_name = result_dict["repo"].split(":")[1][:-4]
             GheFinding = namedtuple('GheFinding', ['repo','commitObj','reason', 'path','linenum'])
             ghe_findings = defaultdict(list)
-            logging.info("Processing choctaw_hog output for Git comments and Insights...")
-            for finding in result_list:
-                # Part 1: Prep the insights findings
-                fileurl = ""
-                if finding["new_line_num"] != 0:
-                    fileurl = f"{result_dict['url']}/blob/{finding['commitHash']}/{finding['path']}#L{finding['new_line_num']}"
-                else:
-                    fileurl = f"{result_dict['url']}/blob/{finding['parent_commit_hash']}/{finding['path']}#L{finding['old_line_num']}"
-                output_array.append(
-                    {
-                        "eventType": "ghe_secret_monitor",
-                        "commitHash": finding["commitHash"],
-                        "reason": finding["reason"],
-                        "path": finding["path"],
-                        "repo": result_dict["repo"],
-                        "url": f"{result_dict['url']}/commit/{finding['commitHash']}/{finding['path']}",
-                        "fileurl": fileurl,
-                        "old_line_num": finding["old_line_num"],
-                        "new_line_num": finding["new_line_num"],
-                        "parent_commitHash": finding["parent_commit_hash"]
-                    }
-                )
-
-                # Part 2: Collate the comments
-                if finding["reason"] not in comment_worthy_reasons:
+            logging.info("Processing choctaw_hog output for Git comments...")
+            for finding in result_dict["findings"]:
+                # Collate the comments
+                if finding["reason"] not in COMMENT_WORTHY:
                     continue
-                repo_name = result_dict["repo"].split(":")[1][:-4]
-                r = g.get_repo(repo_name)
-                c = r.get_commit(finding["commitHash"])
+                c = get_commit(repo_name, finding["commitHash"])
                 ghe_findings[finding["commitHash"]].append(GheFinding(repo_name, c, finding['reason'], finding['path'], finding['new_line_num']))
 
-            # Part 3: Create the GHE comments
+            # Create the GHE comments
             for c_hash, finding_tuples in ghe_findings.items():
                 author_names = {ft.commitObj.author.login for ft in finding_tuples}
                 author_names = " ".join(author_names)
@@ -231,25 +316,39 @@ def main():
                         f"in the Git history and can be recovered by an attacker, so it may still be "
                         f"prudent to rotate the secret."
                     )
-                logging.info(f"Creating Github comment for {result_dict['repo']} {finding['commitHash']}")
-                c.create_comment(body)
+                logging.info(f"Creating Github comment for {result_dict['repo']} {c_hash}")
+                finding_tuples[0].commitObj.create_comment(body)
 
 
-        os.remove(result_dict["results"])
+    if not output_array:
+        logging.info("no findings, nothing to submit to New Relic Insights")
+        return
 
-    url = "https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+    url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
     headers = {
         "Content-Type": "application/json",
         "X-Insert-Key": INSIGHTS_INSERT_KEY,
-        "Content-Encoding": "gzip",
     }
-    post = gzip.compress(json.dumps(output_array).encode("utf-8"))
     logging.info(f"len(output_array) = {len(output_array)}")
     logging.debug(output_array)
     logging.info("Submitting data to New Relic Insights...")
-    r = requests.post(url, data=post, headers=headers)
-    logging.info(f"insights status code: {r.status_code}")
+
+    def post_batch(batch):
+        post = orjson.dumps(batch)
+        # compressing a small payload costs more than it saves, and level 1 is much faster than the default
+        # for a negligible difference in size
+        if len(post) < GZIP_MIN_SIZE:
+            r = SESSION.post(url, data=post, headers=headers)
+        else:
+            post = gzip.compress(post, compresslevel=1)
+            r = SESSION.post(url, data=post, headers={**headers, "Content-Encoding": "gzip"})
+        logging.info(f"insights status code: {r.status_code}")
+        r.raise_for_status()
+
+    batches = [output_array[i:i + INSIGHTS_BATCH_SIZE] for i in range(0, len(output_array), INSIGHTS_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=INSIGHTS_WORKERS) as executor:
+        # consume the results so a failed POST still fails the run
+        list(executor.map(post_batch, batches))
 
 if __name__ == '__main__':
-    freeze_support()
     main()
\ No newline at end of file
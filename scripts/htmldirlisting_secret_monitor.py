@@ -5,17 +5,23 @@
 
 import os
 import gzip
+import io
 import pprint
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import shutil
 import tempfile
 import sys
 import subprocess
 import json
+import orjson
 import logging
 import xml.etree.ElementTree as ET
+import bs4
 import htmllistparse
-import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 loglevel = "WARNING"
@@ -34,6 +40,23 @@ INSIGHTS_INSERT_KEY = os.environ["INSIGHTS_INSERT_KEY"]
 INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 DUROC_HOG_PATH = os.environ["DUROC_HOG_PATH"]
 
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=8,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+    ),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# downloads are mostly waiting on the network, so use more workers than cores
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 # config file format: [ { "url": string, "regex": string, "name": string, "recursive": bool } ... ]
 # example: [ { "url":"https://download.newrelic.com/php_agent/release/", "regex":".*\\.tar\\.gz", "name":"PHP Agent", "recursive": false} ]
 
@@ -42,30 +65,47 @@ config = json.load(f_j)
 output_array = []
 
 
-def scan_binary(url, file_item, name):
-    logging.debug(f"scan_binary({url}, {file_item}, {name}")
+def download_binary(url, file_item, staging_dir):
+    logging.debug(f"download_binary({url}, {file_item}, {staging_dir}")
+    tempfile_path = os.path.join(staging_dir, file_item.name)
+    with session.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(tempfile_path, "wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1 << 16)
+
+
+def scan_binaries(scan_args, name):
+    # download every matching file from a listing into one directory and scan it with a single duroc_hog run,
+    # rather than paying the duroc_hog startup cost once per file
+    logging.debug(f"scan_binaries({scan_args}, {name}")
     output_array = []
-    r = requests.get(url)
-    tempdir = tempfile.gettempdir()
-    tempfile_path = os.path.join(tempdir, file_item.name)
-    f = open(tempfile_path, "wb")
-    f.write(r.content)
-    f.close()
-
-    duroc_hog_output = subprocess.run(
-        [DUROC_HOG_PATH, "-z", tempfile_path], capture_output=True, check=True
-    )
-    json_output = json.loads(duroc_hog_output.stdout)
-    os.remove(tempfile_path)
+    if not scan_args:
+        return output_array
+    urls = {file_item.name: url for url, file_item in scan_args}
+    staging_dir = tempfile.mkdtemp(prefix="listing_")
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(lambda args: download_binary(*args, staging_dir), scan_args))
+
+        duroc_hog_output = subprocess.run(
+            [DUROC_HOG_PATH, "-z", staging_dir], capture_output=True, check=True
+        )
+        json_output = json.loads(duroc_hog_output.stdout)
+    finally:
+        shutil.rmtree(staging_dir)
 
     for finding in json_output:
+        # finding paths look like <staging_dir>/<filename>/<path inside the archive>
+        path = os.path.relpath(finding["path"], staging_dir)
+        filename = path.split(os.sep)[0]
         output_array.append(
             {
                 "eventType": "htmldirlisting_secret_monitor",
                 "reason": finding["reason"],
-                "path": finding["path"],
-                "url": url,
-                "filename": file_item.name,
+                "path": path,
+                "url": urls[filename],
+                "filename": filename,
                 "name": name,
             }
         )
@@ -73,39 +113,86 @@ def scan_binary(url, file_item, name):
     return output_array
 
 
+def fetch_listing(url):
+    # same as htmllistparse.fetch_listing, but through our session so a server that is rate limiting us
+    # gets backed off from (honoring Retry-After) instead of us sleeping before every request
+    try:
+        r = session.get(url, timeout=15)
+        r.raise_for_status()
+        cwd, listing = htmllistparse.parse(bs4.BeautifulSoup(r.content, "html5lib"))
+    except:
+        logging.error(f"fetching the listing at {url} returned an exception")
+        return url, []
+    return url, listing
+
+
 def scan_url(url, regex, name, recursive):
-    time.sleep(1)
     logging.debug(f"scan_url({url}, {regex}, {name}, {recursive}")
     output_array = []
-    try:
-        cwd, listing = htmllistparse.fetch_listing(url, timeout=15)
-        for file_item in listing:
-            if not file_item.size and recursive:
-                scan_url(urljoin(url, file_item.name), regex, name)
-            elif regex.search(file_item.name):
-                file_url = urljoin(config_item["url"], file_item.name)
-                output_array.extend(scan_binary(file_url, file_item, name))
-    except:
-        logging.error(f"htmllistparse.fetch_listing({url}, timeout=15) returned an exception")
+    # walk the directory tree breadth first instead of recursing, fetching each level's listings concurrently
+    listings = {}
+    seen = {url}
+    pending = [url]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while pending:
+            next_pending = []
+            for dir_url, listing in executor.map(fetch_listing, pending):
+                scan_args = listings.setdefault(dir_url, [])
+                for file_item in listing:
+                    item_url = urljoin(dir_url, file_item.name)
+                    if not file_item.size and recursive:
+                        if item_url not in seen:
+                            seen.add(item_url)
+                            next_pending.append(item_url)
+                    elif regex.search(file_item.name):
+                        scan_args.append((item_url, file_item))
+            pending = next_pending
+
+    for dir_url, scan_args in listings.items():
+        try:
+            output_array.extend(scan_binaries(scan_args, name))
+        except:
+            logging.warning(f"scanning the files in {dir_url} returned an exception, scanning them one at a time")
+            # a single corrupt archive fails the whole batch, so rescan the listing one file per run and only
+            # lose the files that fail on their own
+            for scan_arg in scan_args:
+                try:
+                    output_array.extend(scan_binaries([scan_arg], name))
+                except:
+                    logging.error(f"scanning {scan_arg[0]} returned an exception")
     return output_array
 
 
-for config_item in config:
-    output_array.extend(
-        scan_url(config_item["url"], re.compile(config_item["regex"]), config_item["name"], config_item["recursive"])
-    )
+def scan_config_item(config_item):
+    return scan_url(config_item["url"], re.compile(config_item["regex"]), config_item["name"], config_item["recursive"])
+
+
+# the config entries are usually on different servers, so walk them at the same time instead of one after another
+with ThreadPoolExecutor(max_workers=4) as executor:
+    for results in executor.map(scan_config_item, config):
+        output_array.extend(results)
 
-url = "https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
 headers = {
     "Content-Type": "application/json",
     "X-Insert-Key": INSIGHTS_INSERT_KEY,
     "Content-Encoding": "gzip",
 }
-post = gzip.compress(json.dumps(output_array).encode("utf-8"))
+# level 6 gets nearly all of level 9's compression for much less CPU
+buf = io.BytesIO()
+with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as gz:
+    gz.write(b"[")
+    for i, event in enumerate(output_array):
+        if i:
+            gz.write(b",")
+        gz.write(orjson.dumps(event))
+    gz.write(b"]")
+post = buf.getvalue()
 logging.info(f"len(output_array) = {len(output_array)}")
 logging.debug(output_array)
 logging.info("Submitting data to New Relic Insights...")
-r = requests.post(url, data=post, headers=headers)
+r = session.post(url, data=post, headers=headers)
 logging.info(f"insights status code: {r.status_code}")
+r.raise_for_status()
 
 #
@@ -1,15 +1,24 @@
+# This is a Python script that scans all JIRA tickets modified in the last 24 hours for secrets using gottingen_hog,
+# and the GDrive docs linked from those tickets using ankamali_hog. It then outputs the results to New Relic Insights.
+# It requires two third party libraries: https://github.com/psf/requests and https://github.com/ijl/orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import re
 import tempfile
 import os
 import subprocess
-import uuid
-import json
+import atexit
+import glob
+import time
+import orjson
 import gzip
+import io
 import sys
 import datetime
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 if len(sys.argv) == 2 and sys.argv[1].startswith("--log="):
     loglevel = sys.argv[1][6:]
@@ -29,31 +38,131 @@ ANKAMALI_HOG_PATH = os.environ["ANKAMALI_HOG_PATH"]
 GOTTINGEN_HOG_PATH = os.environ["GOTTINGEN_HOG_PATH"]
 INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 
+# the hogs spend most of their time waiting on the network, so run more of them than there are cores,
+# and don't let a stuck one hold up a worker forever
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+HOG_TIMEOUT = 300
+
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+INSIGHTS_URL = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+INSIGHTS_HEADERS = {
+    "Content-Type": "application/json",
+    "X-Insert-Key": INSIGHTS_INSERT_KEY,
+    "Content-Encoding": "gzip",
+}
+
+
+def post_events(events, batch=2000):
+    # send everything in a few large POSTs instead of one per hog, level 6 gets nearly all of
+    # level 9's compression for much less CPU
+    for i in range(0, len(events), batch):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as gz:
+            gz.write(b"[")
+            for j, event in enumerate(events[i:i + batch]):
+                if j:
+                    gz.write(b",")
+                gz.write(orjson.dumps(event))
+            gz.write(b"]")
+        post = buf.getvalue()
+        r = session.post(INSIGHTS_URL, data=post, headers=INSIGHTS_HEADERS, timeout=30)
+        logging.info(f"insights status code: {r.status_code}")
+        r.raise_for_status()
+
+
+def load_result(result_dict):
+    # reading, parsing and deleting the result files is mostly waiting on disk, so this runs in a thread pool
+    try:
+        f = open(result_dict["results"], "rb")
+    except:
+        # TODO: add better error handling here. the file won't exist if we couldn't
+        # access the file
+        logging.warning("failed to open " + result_dict["results"])
+        return result_dict, None
+
+    with f:
+        contents = f.read()
+    os.remove(result_dict["results"])
+    if not contents:
+        # the file is created before the hog runs, so it is empty if the hog failed
+        logging.warning("no results written to " + result_dict["results"])
+        return result_dict, None
+    return result_dict, orjson.loads(contents)
+
+
+# only links with a /d/<id> segment can be scanned, so capture the doc id in the same pass
+gdoc_re = re.compile(r'https://docs\.google\.com/\w+/d/([A-Za-z0-9_-]+)', re.IGNORECASE)
+
+tempdir = tempfile.gettempdir()
+# the other monitors put their own hog_*.json files in the same temp dir, so only ever touch ours
+RESULTS_PREFIX = "jira_hog_"
+start_time = time.time()
+
+
+def results_file():
+    # let tempfile pick a unique name atomically, the hog overwrites the empty file
+    with tempfile.NamedTemporaryFile(delete=False, dir=tempdir, prefix=RESULTS_PREFIX, suffix=".json") as tf:
+        return tf.name
+
+
+def cleanup():
+    # remove results left behind by earlier runs that crashed, anything this run still needs is
+    # newer than twice its runtime
+    cutoff = time.time() - 2 * (time.time() - start_time)
+    for path in glob.glob(os.path.join(tempdir, f"{RESULTS_PREFIX}*.json")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+atexit.register(cleanup)
+
 search_query = 'updatedDate >= startOfDay()'
 # search_query = 'updatedDate >= "2020-04-16 16:00"'
-start_num=0
-url = f"{JIRA_URL}rest/api/2/search?jql={search_query}&startAt={start_num}"
-tempdir = tempfile.gettempdir()
+search_url = f"{JIRA_URL}rest/api/2/search"
+
+
+def search_params(start_num):
+    # only the description is read from each issue, so don't have JIRA send the rest of the fields
+    return {"jql": search_query, "fields": "description", "startAt": start_num, "maxResults": 100}
+
+
 issues = []
-r = requests.get(url, auth=(JIRA_USERNAME, JIRA_PASSWORD))
+r = session.get(search_url, params=search_params(0), auth=(JIRA_USERNAME, JIRA_PASSWORD), timeout=30)
 result = None
 
 try:
-    result = r.json()
+    result = orjson.loads(r.content)
 except:
     print(f"JIRA error: {r.text}")
     sys.exit(1)
 total = result['total']
+max_results = result['maxResults']
 issues.extend(result['issues'])
-while len(issues) < total:
-    start_num += result['maxResults']
-    logging.info(f"Retrieving results {start_num}-{start_num+result['maxResults']} of {total}")
-    url = f"{JIRA_URL}rest/api/2/search?jql={search_query}&startAt={start_num}"
-    r = requests.get(url, auth=(JIRA_USERNAME, JIRA_PASSWORD))
-    result = r.json()
-    issues.extend(result['issues'])
-
-gdoc_re = re.compile(r'https://docs.google.com/[^\s|\]]+', re.IGNORECASE)
+
+
+def fetch_issues(start_num):
+    logging.info(f"Retrieving results {start_num}-{start_num+max_results} of {total}")
+    r = session.get(search_url, params=search_params(start_num), auth=(JIRA_USERNAME, JIRA_PASSWORD), timeout=30)
+    return orjson.loads(r.content)['issues']
+
+
+# the first page tells us how many issues there are and how many the server returns per page, so request
+# the rest by startAt offset concurrently, executor.map keeps them in order
+with ThreadPoolExecutor(max_workers=8) as executor:
+    for page in executor.map(fetch_issues, range(max_results, total, max_results)):
+        issues.extend(page)
+
 links = defaultdict(set)
 
 logging.info("Reading issue descriptions...")
@@ -62,39 +171,38 @@ for issue in issues:
     description = issue['fields']['description']
     if not description:
         continue
-    # find any google doc links and add them to our list
-    matches = gdoc_re.findall(description)
-    for match in matches:
-        links[issue['key']].add(match)
+    # find any google doc ids and add them to our list
+    links[issue['key']].update(gdoc_re.findall(description))
 
 
-logging.info("Retrieving issue comments...")
-for issue in issues:
+def fetch_comments(issue):
     # hit the JIRA API to retrieve the comments for each issue
     url = f"{JIRA_URL}rest/api/2/issue/{issue['key']}/comment"
-    r = requests.get(url, auth=(JIRA_USERNAME, JIRA_PASSWORD))
-    comments = r.json().get('comments', [])
-    for comment in comments:
-        # find any google doc links in the comment and add them to our list (links)
-        matches = gdoc_re.findall(comment['body'])
-        for match in matches:
-            links[issue['key']].add(match)
-
-gdoc_id_re = re.compile(r'https://docs.google.com/\w+/d/([a-zA-Z0-9-_]+)/?.*',re.IGNORECASE)
+    r = session.get(url, auth=(JIRA_USERNAME, JIRA_PASSWORD), timeout=30)
+    return issue['key'], orjson.loads(r.content).get('comments', [])
+
+
+logging.info("Retrieving issue comments...")
+# each issue's comments are a separate request, so fetch them concurrently
+with ThreadPoolExecutor(max_workers=16) as executor:
+    for key, comments in executor.map(fetch_comments, issues):
+        for comment in comments:
+            # find any google doc ids in the comment and add them to our list (links)
+            links[key].update(gdoc_re.findall(comment['body']))
+
 output = []
 
-logging.info("Running ankamali hog on each Google Drive link found in Jira...")
-for x in links.items():
-    logging.debug(f"x: {str(x)}")
-    filename = os.path.join(tempdir, str(uuid.uuid4()))
-    results = []
-    for gdoc_link in x[1]:
-        logging.debug(f"gdoc_link: {gdoc_link}")
-        logging.debug(f"gdoc_id_re.match(gdoc_link): {str(gdoc_id_re.match(gdoc_link))}")
-        gdoc_id_match = gdoc_id_re.match(gdoc_link)
-        if not gdoc_id_match:
-            continue
-        gdocid = gdoc_id_match.group(1)
+# the same doc is often linked from several issues, so scan each doc once and report its findings on every issue
+gdocid_to_issues = defaultdict(set)
+for key, gdocids in links.items():
+    for gdocid in gdocids:
+        gdocid_to_issues[gdocid].add(key)
+
+
+def run_ankamali(gdocid):
+    # every run gets its own output file so they can run concurrently
+    filename = results_file()
+    try:
         s = subprocess.run(
             [
                 ANKAMALI_HOG_PATH,
@@ -102,59 +210,53 @@ for x in links.items():
                 filename,
                 gdocid
             ],
-            capture_output=True
+            capture_output=True,
+            timeout=HOG_TIMEOUT
         )
-        logging.debug(f"ankamali hog output: {s.stdout}")
-        if s.returncode != 0:
-            logging.warning(f"ankamali hog exited with a non-zero status code: {s.stdout} {s.stderr}")
-        # TODO: add better error handling here. some will fail because you don't have
-        # permission to the doc. others will fail because you setup your token wrong.
-        results.append({"gdoc_link": gdoc_link, "results": filename, "key": x[0]})
-    output.extend(results)
+    except subprocess.TimeoutExpired:
+        logging.warning(f"ankamali hog timed out scanning {gdocid}")
+        os.remove(filename)
+        return None
+    logging.debug(f"ankamali hog output: {s.stdout}")
+    if s.returncode != 0:
+        logging.warning(f"ankamali hog exited with a non-zero status code: {s.stdout} {s.stderr}")
+    # TODO: add better error handling here. some will fail because you don't have
+    # permission to the doc. others will fail because you setup your token wrong.
+    return {"gdocid": gdocid, "results": filename, "keys": gdocid_to_issues[gdocid]}
+
+
+logging.info("Running ankamali hog on each Google Drive link found in Jira...")
+# each hog is an independent subprocess, so run one per doc, several at once
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    futures = [executor.submit(run_ankamali, gdocid) for gdocid in gdocid_to_issues]
+    for future in as_completed(futures):
+        result_dict = future.result()
+        if result_dict:
+            output.append(result_dict)
 
 logging.info(f"len(output) = {len(output)}")
 
-# iterate through each JSON file from choctaw_hog and put the results in Insights
+# iterate through each JSON file from ankamali_hog and collect the results for Insights
 output_array = []
-for result_dict in output:
-    try:
-        f = open(result_dict["results"], "r")
-    except:
-        # TODO: add better error handling here. the file won't exist if we couldn't
-        # access the file
-        logging.warning("failed to open " + result_dict["results"])
-        continue
-
-    with f:
-        result_list = json.load(f)
+with ThreadPoolExecutor(max_workers=16) as executor:
+    for result_dict, result_list in executor.map(load_result, output):
+        if result_list is None:
+            continue
         for finding in result_list:
-            output_array.append(
-                {
-                    "eventType": "gdrive_secret_monitor",
-                    "jira_key": result_dict["key"],
-                    "g_drive_id": finding["g_drive_id"],
-                    "url": finding["web_link"],
-                    "reason": finding["reason"]
-                }
-            )
-    os.remove(result_dict["results"])
+            for key in result_dict["keys"]:
+                output_array.append(
+                    {
+                        "eventType": "gdrive_secret_monitor",
+                        "jira_key": key,
+                        "g_drive_id": finding["g_drive_id"],
+                        "url": finding["web_link"],
+                        "reason": finding["reason"]
+                    }
+                )
 
-url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
-headers = {
-    "Content-Type": "application/json",
-    "X-Insert-Key": INSIGHTS_INSERT_KEY,
-    "Content-Encoding": "gzip",
-}
-post = gzip.compress(json.dumps(output_array).encode("utf-8"))
-logging.info(f"len(output_array) = {len(output_array)}")
-logging.debug(output_array)
-r = requests.post(url, data=post, headers=headers)
-logging.info(f"insights status code: {r.status_code}")
 
-logging.info("Running gottingen hog on each JIRA issue...")
-results = []
-for issue in issues:
-    filename = os.path.join(tempdir, str(uuid.uuid4()))
+def run_gottingen(issue):
+    filename = results_file()
     cmdline = [
             GOTTINGEN_HOG_PATH,
             "--outputfile",
@@ -168,31 +270,36 @@ for issue in issues:
             issue['key']
         ]
     logging.info(f"Running gottingen hog: {cmdline}")
-    s = subprocess.run(
-        cmdline,
-        capture_output=True
-    )
+    try:
+        s = subprocess.run(
+            cmdline,
+            capture_output=True,
+            timeout=HOG_TIMEOUT
+        )
+    except subprocess.TimeoutExpired:
+        logging.warning(f"gottingen hog timed out scanning {issue['key']}")
+        return {"results": filename}
     logging.debug(f"gottingen hog output: {s.stdout}")
     if s.returncode != 0:
         logging.warning(f"gottingen hog exited with a non-zero status code: {s.stdout} {s.stderr}")
     # TODO: add better error handling here.
-    results.append({"results": filename})
+    return {"results": filename}
 
-logging.info(f"len(results) = {len(results)}")
 
-# iterate through each JSON file from gottingen_hog and put the results in Insights
-output_array = []
-for result_dict in results:
-    try:
-        f = open(result_dict["results"], "r")
-    except:
-        # TODO: add better error handling here. the file won't exist if we couldn't
-        # access the file
-        logging.warning("failed to open " + result_dict["results"])
-        continue
+logging.info("Running gottingen hog on each JIRA issue...")
+results = []
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    futures = [executor.submit(run_gottingen, issue) for issue in issues]
+    for future in as_completed(futures):
+        results.append(future.result())
 
-    with f:
-        result_list = json.load(f)
+logging.info(f"len(results) = {len(results)}")
+
+# iterate through each JSON file from gottingen_hog and add the results to the same Insights events
+with ThreadPoolExecutor(max_workers=16) as executor:
+    for result_dict, result_list in executor.map(load_result, results):
+        if result_list is None:
+            continue
         for finding in result_list:
             output_array.append(
                 {
@@ -203,16 +310,7 @@ for result_dict in results:
                     "location": finding["location"],
                 }
             )
-    os.remove(result_dict["results"])
 
-url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
-headers = {
-    "Content-Type": "application/json",
-    "X-Insert-Key": INSIGHTS_INSERT_KEY,
-    "Content-Encoding": "gzip",
-}
-post = gzip.compress(json.dumps(output_array).encode("utf-8"))
 logging.info(f"len(output_array) = {len(output_array)}")
 logging.debug(output_array)
-r = requests.post(url, data=post, headers=headers)
-logging.info(f"insights status code: {r.status_code}")
+post_events(output_array)
@@ -8,12 +8,14 @@ import gzip
 import pprint
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import shutil
 import tempfile
 import sys
 import subprocess
 import json
 import logging
-import xml.etree.ElementTree as ET
 
 loglevel = "WARNING"
 for arg in sys.argv:
@@ -31,25 +33,34 @@ INSIGHTS_INSERT_KEY = os.environ["INSIGHTS_INSERT_KEY"]
 INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 DUROC_HOG_PATH = os.environ["DUROC_HOG_PATH"]
 
+# the simple index is HTML rather than XML, so pull the hrefs out with a regex instead of an XML parser
+href_regex = re.compile(r'<a\s[^>]*href="([^"]+)"', re.IGNORECASE)
+link_regex = re.compile(rf"({re.escape(PYPIPACKAGE_NAME)})-([\d\-\.]+)\.tar\.gz", re.IGNORECASE)
 
-r = requests.get(f"https://pypi.org/simple/{PYPIPACKAGE_NAME}/")
-et_result = ET.fromstring(r.text)
-links = []
-for link_element in et_result[1]:
-    if 'href' in link_element.attrib:
-        links.append(link_element.attrib['href'])
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+
+r = session.get(f"https://pypi.org/simple/{PYPIPACKAGE_NAME}/", timeout=30)
+links = href_regex.findall(r.text)
 
 url = links[-1]
-link_regex = re.compile(f"({PYPIPACKAGE_NAME})-([\d\-\.]+)\.tar\.gz", re.IGNORECASE)
 link_regex_match = link_regex.search(url)
 (pypi_title, pypi_version) = link_regex_match.groups()
 
-r = requests.get(url)
 tempdir = tempfile.gettempdir()
 tempfile = os.path.join(tempdir, f"{pypi_title}-{pypi_version}.tar.gz")
-f = open(tempfile, "wb")
-f.write(r.content)
-f.close()
+with session.get(url, stream=True, timeout=60) as r:
+    r.raise_for_status()
+    r.raw.decode_content = True
+    with open(tempfile, "wb") as f:
+        shutil.copyfileobj(r.raw, f, length=1 << 16)
 
 duroc_hog_output = subprocess.run([DUROC_HOG_PATH, '-z', tempfile], capture_output=True, check=True)
 json_output = json.loads(duroc_hog_output.stdout)
@@ -66,7 +77,7 @@ for finding in json_output:
         'pypi_version': pypi_version
     })
 
-url = "https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
 headers = {
     "Content-Type": "application/json",
     "X-Insert-Key": INSIGHTS_INSERT_KEY,
@@ -76,7 +87,8 @@ post = gzip.compress(json.dumps(output_array).encode("utf-8"))
 logging.info(f"len(output_array) = {len(output_array)}")
 logging.debug(output_array)
 logging.info("Submitting data to New Relic Insights...")
-r = requests.post(url, data=post, headers=headers)
+r = session.post(url, data=post, headers=headers)
 logging.info(f"insights status code: {r.status_code}")
+r.raise_for_status()
 
 
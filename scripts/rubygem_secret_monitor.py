@@ -4,10 +4,12 @@
 # Rusty Hog scan on the contents of the download. It will then post the results to Insights.
 
 import os
-import feedparser
 import gzip
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import shutil
 import tempfile
 import sys
 import subprocess
@@ -30,18 +32,31 @@ INSIGHTS_INSERT_KEY = os.environ["INSIGHTS_INSERT_KEY"]
 INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 DUROC_HOG_PATH = os.environ["DUROC_HOG_PATH"]
 
-feed_result = feedparser.parse(f"https://rubygems.org/gems/{RUBYGEM_NAME}/versions.atom")
-latest_gem = feed_result['entries'][0]['title']
-title_regex = re.compile("(.*)\s+\(([0-9\.]+)\)")
-(gem_title, gem_version) = title_regex.match(latest_gem).groups()
+# the newest version is the first entry title in the feed, e.g. <title>newrelic_rpm (6.10.0)</title>, and it is
+# the only field we need, so pull it out with a regex instead of parsing the whole feed
+title_regex = re.compile(r"<title>([^<]*?)\s+\(([0-9\.]+)\)</title>")
+
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+r = session.get(f"https://rubygems.org/gems/{RUBYGEM_NAME}/versions.atom", timeout=30)
+r.raise_for_status()
+(gem_title, gem_version) = title_regex.search(r.text).groups()
 
 url = f"https://rubygems.org/downloads/{gem_title}-{gem_version}.gem"
-r = requests.get(url)
 tempdir = tempfile.gettempdir()
 tempfile = os.path.join(tempdir, f"{gem_title}-{gem_version}.gem")
-f = open(tempfile, "wb")
-f.write(r.content)
-f.close()
+with session.get(url, stream=True, timeout=60) as r:
+    r.raise_for_status()
+    r.raw.decode_content = True
+    with open(tempfile, "wb") as f:
+        shutil.copyfileobj(r.raw, f, length=1 << 16)
 
 duroc_hog_output = subprocess.run([DUROC_HOG_PATH, '-z', tempfile], capture_output=True, check=True)
 json_output = json.loads(duroc_hog_output.stdout)
@@ -58,7 +73,7 @@ for finding in json_output:
         'gem_version': gem_version
     })
 
-url = "https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
 headers = {
     "Content-Type": "application/json",
     "X-Insert-Key": INSIGHTS_INSERT_KEY,
@@ -68,7 +83,8 @@ post = gzip.compress(json.dumps(output_array).encode("utf-8"))
 logging.info(f"len(output_array) = {len(output_array)}")
 logging.debug(output_array)
 logging.info("Submitting data to New Relic Insights...")
-r = requests.post(url, data=post, headers=headers)
+r = session.post(url, data=post, headers=headers)
 logging.info(f"insights status code: {r.status_code}")
+r.raise_for_status()
 
 
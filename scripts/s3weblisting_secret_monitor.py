@@ -5,20 +5,27 @@
 
 import os
 import gzip
+import io
 import pprint
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import shutil
 import tempfile
 import sys
 import subprocess
 import json
+import orjson
 import logging
-import xml.etree.ElementTree as ET
+import sqlite3
+from lxml import etree
 import htmllistparse
 import time
 import urllib.parse
-import copy
 from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 loglevel = "WARNING"
 for arg in sys.argv:
@@ -35,6 +42,21 @@ DOWNLOAD_CONFIG_PATH = os.environ["DOWNLOAD_CONFIG_PATH"]
 INSIGHTS_INSERT_KEY = os.environ["INSIGHTS_INSERT_KEY"]
 INSIGHTS_ACCT_ID = os.environ["INSIGHTS_ACCT_ID"]
 DUROC_HOG_PATH = os.environ["DUROC_HOG_PATH"]
+# optional, where to record which objects have already been scanned
+SCANNED_DB_PATH = os.environ.get(
+    "SCANNED_DB_PATH", os.path.join(tempfile.gettempdir(), "s3weblisting_secret_monitor_scanned.sqlite")
+)
+
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
 
 # config file format: [ { "url": string, "regex": string, "name": string, "recursive": bool } ... ]
 # example: [ { "url":"https://download.newrelic.com/php_agent/release/", "regex":".*\\.tar\\.gz", "name":"PHP Agent", "recursive": false} ]
@@ -43,31 +65,75 @@ f_j = open(DOWNLOAD_CONFIG_PATH, "r")
 config = json.load(f_j)
 output_array = []
 
+NS = {'aws': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+# compile the XPath expressions once instead of on every listing
+prefixes_xp = etree.XPath('./aws:CommonPrefixes/aws:Prefix/text()', namespaces=NS)
+is_truncated_xp = etree.XPath('string(./aws:IsTruncated)', namespaces=NS)
+next_token_xp = etree.XPath('string(./aws:NextContinuationToken)', namespaces=NS)
+# fully qualified tags of a Contents entry and its children
+CONTENTS_TAG = f"{{{NS['aws']}}}Contents"
+KEY_TAG = f"{{{NS['aws']}}}Key"
+SIZE_TAG = f"{{{NS['aws']}}}Size"
+LAST_MODIFIED_TAG = f"{{{NS['aws']}}}LastModified"
+ETAG_TAG = f"{{{NS['aws']}}}ETag"
 
-def scan_binary(file_url, content_item, config_item):
-    logging.debug(f"scan_binary({file_url}, {content_item}, {config_item}")
-    output_array = []
-    r = requests.get(file_url)
-    tempdir = tempfile.gettempdir()
+# objects whose ETag hasn't changed since they were last scanned can't have any new findings, so skip them
+scanned_db = sqlite3.connect(SCANNED_DB_PATH)
+scanned_db.execute("CREATE TABLE IF NOT EXISTS scanned(k TEXT PRIMARY KEY, etag TEXT)")
+
+
+# (url, etag) of every object scanned this run, only written to the table once the findings are submitted,
+# otherwise a failed submission would lose them for good
+scanned_rows = []
+
+
+def already_scanned(file_url, etag):
+    return scanned_db.execute("SELECT 1 FROM scanned WHERE k = ? AND etag = ?", (file_url, etag)).fetchone() is not None
+
+
+def record_scanned():
+    with scanned_db:
+        scanned_db.executemany("INSERT OR REPLACE INTO scanned(k, etag) VALUES (?, ?)", scanned_rows)
+
+
+def download_binary(file_url, staging_dir):
+    logging.debug(f"download_binary({file_url}, {staging_dir}")
     filename = os.path.basename(urllib.parse.urlparse(file_url).path)
-    tempfile_path = os.path.join(tempdir, filename)
-    f = open(tempfile_path, "wb")
-    f.write(r.content)
-    f.close()
+    tempfile_path = os.path.join(staging_dir, filename)
+    with session.get(file_url, stream=True, timeout=(5, 300)) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(tempfile_path, "wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
+
+
+def scan_binaries(scan_args, config_item):
+    logging.debug(f"scan_binaries({scan_args}, {config_item}")
+    output_array = []
+    if not scan_args:
+        return output_array
+    urls = {os.path.basename(urllib.parse.urlparse(file_url).path): file_url for file_url, _, _ in scan_args}
+    staging_dir = tempfile.mkdtemp(prefix="listing_")
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(lambda args: download_binary(args[0], staging_dir), scan_args))
 
-    duroc_hog_output = subprocess.run(
-        [DUROC_HOG_PATH, "-z", tempfile_path], capture_output=True, check=True
-    )
-    json_output = json.loads(duroc_hog_output.stdout)
-    os.remove(tempfile_path)
+        # only stdout is captured, duroc_hog's stderr goes straight to ours so failures show up in the log
+        cmdline = [DUROC_HOG_PATH, "-z", staging_dir]
+        duroc_hog_output = subprocess.run(cmdline, stdout=subprocess.PIPE, check=True)
+        json_output = orjson.loads(duroc_hog_output.stdout)
+    finally:
+        shutil.rmtree(staging_dir)
 
     for finding in json_output:
+        path = os.path.relpath(finding["path"], staging_dir)
+        filename = path.split(os.sep)[0]
         output_array.append(
             {
                 "eventType": "s3weblisting_secret_monitor",
                 "reason": finding["reason"],
-                "path": finding["path"],
-                "url": file_url,
+                "path": path,
+                "url": urls[filename],
                 "filename": filename,
                 "name": config_item['name'],
             }
@@ -76,39 +142,89 @@ def scan_binary(file_url, content_item, config_item):
     return output_array
 
 
-def scan_endpoint(config_item):
+def list_endpoint(config_item, prefixes, regex, after_date):
+    # the regex and date are parsed once by the caller and passed down through the recursion
     endpoint = config_item['endpoint']
-    regex = re.compile(config_item['regex'])
-    name = config_item['name']
     recursive = config_item['recursive']
-    prefixes = config_item['prefixes']
-    after_date = datetime.fromisoformat(config_item['after_date'])
-    logging.debug(f"scan_endpoint({config_item}")
-    output_array = []
-    ns = {'aws': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+    logging.debug(f"list_endpoint({config_item}, {prefixes}")
+    scan_args = []
 
     for prefix in prefixes:
-        url = f"https://{endpoint}.s3.amazonaws.com/?delimiter=/&prefix={prefix}"
-        et_root = None
+        base_url = f"https://{endpoint}.s3.amazonaws.com/?list-type=2&delimiter=/&prefix={urllib.parse.quote(prefix)}"
+        url = base_url
+        new_prefixes = []
+        while url:
+            et_root = None
+            try:
+                # parse the Contents entries straight off the response as it arrives, dropping each one once it
+                # has been read, so only the pagination fields and the common prefixes are left to query afterwards
+                with session.get(url, stream=True, timeout=(5, 60)) as r:
+                    r.raise_for_status()
+                    r.raw.decode_content = True
+                    context = etree.iterparse(r.raw, events=("end",), tag=CONTENTS_TAG)
+                    for _, content_item in context:
+                        # read all of the children in one pass instead of searching them once for each field
+                        fields = {child.tag: child.text for child in content_item}
+                        content_item.clear()
+                        previous = content_item.getprevious()
+                        if previous is not None and previous.tag == CONTENTS_TAG:
+                            content_item.getparent().remove(previous)
+                        key = fields[KEY_TAG]
+                        size = int(fields[SIZE_TAG])
+                        # most keys fail the cheap checks, so only parse the timestamp of the ones that pass them
+                        if size == 0 or not regex.search(key):
+                            continue
+                        # S3 timestamps always end in Z, which fromisoformat doesn't accept before Python 3.11
+                        last_modified = fields[LAST_MODIFIED_TAG]
+                        if datetime.fromisoformat(last_modified[:-1] + '+00:00') <= after_date:
+                            continue
+                        file_url = f"https://{endpoint}.s3.amazonaws.com/{key}"
+                        etag = fields.get(ETAG_TAG)
+                        if etag and already_scanned(file_url, etag):
+                            logging.debug(f"{file_url} hasn't changed since it was last scanned, skipping it")
+                            continue
+                        scan_args.append((file_url, etag, config_item))
+                    et_root = context.root
+            except:
+                logging.error(f"parsing the listing at {url} returned an exception")
+                break
+            new_prefixes.extend(str(common_prefix) for common_prefix in prefixes_xp(et_root))
+            # S3 returns at most 1000 keys per response, keep following the continuation token until it's done
+            url = None
+            if is_truncated_xp(et_root) == 'true':
+                next_token = next_token_xp(et_root)
+                url = f"{base_url}&continuation-token={urllib.parse.quote(next_token, safe='')}"
+        if recursive and len(new_prefixes) > 0:
+            scan_args.extend(list_endpoint(config_item, new_prefixes, regex, after_date))
+
+    return scan_args
+
+
+def scan_endpoint(config_item):
+    logging.debug(f"scan_endpoint({config_item}")
+    output_array = []
+    regex = re.compile(config_item['regex'])
+    after_date = datetime.fromisoformat(config_item['after_date'])
+    # walk the listings first, then scan the matching files one listing at a time, the keys in a single listing
+    # all have different names so they can share a staging directory
+    listings = defaultdict(list)
+    for scan_arg in list_endpoint(config_item, config_item['prefixes'], regex, after_date):
+        listings[scan_arg[0].rsplit("/", 1)[0]].append(scan_arg)
+    for listing_url, scan_args in listings.items():
         try:
-            et_root = ET.fromstring(requests.get(url).text)
+            output_array.extend(scan_binaries(scan_args, config_item))
+            scanned = scan_args
         except:
-            logging.error(f"ET.fromstring(requests.get({url}).text) returned an exception")
-        for content_item in et_root.findall('aws:Contents', ns):
-            # logging.debug(f"content_item: {content_item}")
-            # logging.debug(f"content_item.find('aws:Key', ns): {content_item.find('aws:Key', ns)}")
-            key = content_item.find('aws:Key', ns).text
-            size = int(content_item.find('aws:Size', ns).text)
-            modified = datetime.fromisoformat(content_item.find('aws:LastModified', ns).text.replace('Z', '+00:00'))
-            if regex.search(key) and size > 0 and modified > after_date:
-                file_url = f"https://{endpoint}.s3.amazonaws.com/{key}"
-                output_array.extend(scan_binary(file_url, content_item, config_item))
-        if recursive:
-            new_config_item = copy.deepcopy(config_item)
-            new_prefixes = [content_item[0].text for content_item in et_root.findall('aws:CommonPrefixes', ns)]
-            if len(new_prefixes) > 0:
-                new_config_item['prefixes'] = new_prefixes
-                output_array.extend(scan_endpoint(new_config_item))
+            logging.warning(f"scanning the files in {listing_url} returned an exception, scanning them one at a time")
+            scanned = []
+            for scan_arg in scan_args:
+                try:
+                    output_array.extend(scan_binaries([scan_arg], config_item))
+                except:
+                    logging.error(f"scanning {scan_arg[0]} returned an exception")
+                    continue
+                scanned.append(scan_arg)
+        scanned_rows.extend((file_url, etag) for file_url, etag, _ in scanned if etag)
 
     return output_array
 
@@ -118,17 +234,33 @@ output_array = [result for config_item in config for result in scan_endpoint(con
 # for config_item in config:
 #     output_array.extend(scan_url(config_item))
 
-url = "https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
+if not output_array:
+    logging.info("no findings, nothing to submit to New Relic Insights")
+    record_scanned()
+    sys.exit(0)
+
+url = f"https://insights-collector.newrelic.com/v1/accounts/{INSIGHTS_ACCT_ID}/events"
 headers = {
     "Content-Type": "application/json",
     "X-Insert-Key": INSIGHTS_INSERT_KEY,
     "Content-Encoding": "gzip",
 }
-post = gzip.compress(json.dumps(output_array).encode("utf-8"))
+# level 1 is much faster than the default for a negligible difference in size
+buf = io.BytesIO()
+with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1) as gz:
+    gz.write(b"[")
+    for i, event in enumerate(output_array):
+        if i:
+            gz.write(b",")
+        gz.write(orjson.dumps(event))
+    gz.write(b"]")
+post = buf.getvalue()
 logging.info(f"len(output_array) = {len(output_array)}")
 logging.debug(output_array)
 logging.info("Submitting data to New Relic Insights...")
-r = requests.post(url, data=post, headers=headers)
+r = session.post(url, data=post, headers=headers)
 logging.info(f"insights status code: {r.status_code}")
+r.raise_for_status()
+record_scanned()
 
 #